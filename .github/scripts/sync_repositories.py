@@ -1,23 +1,194 @@
 #!/usr/bin/env python3
 
 import argparse
-import tempfile
+import base64
+import fcntl
+import hashlib
+import json
 import logging
 import os
-from datetime import datetime
-from git import Repo, GitCommandError
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from git import Git, Repo, GitCommandError
 from github import Github, GithubException
+from github.GithubRetry import GithubRetry
 
 logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
 
+# Bare clones of the target repositories are kept here between runs
+CACHE_DIR = Path(os.getenv('SYNC_REPOS_CACHE', Path.home() / '.cache' / 'sync_repos'))
+
+# GitHub rejects pull request bodies longer than this many characters
+PR_BODY_LIMIT = 65536
+TRUNCATED_NOTE = "...\n\nThe list is truncated, see the commits tab for all of them."
+
+# The cherry-pick worktree goes on this tmpfs when it has enough room
+SCRATCH_DIR = '/dev/shm'
+SCRATCH_MIN_FREE = 1024 ** 3
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--target-repo', type=str, required=True, help='The GitHub repository where changes will be applied. Example: scylladb/scylla-enterprise-pkg')
     parser.add_argument('--source-repo', type=str, required=True, help='The GitHub repository from which changes will be merged. Example: scylladb/scylla-pkg')
     parser.add_argument('--target-branch', type=str, required=True, help='The branch in the target repository where changes will be merged. Example: next-enterprise')
     parser.add_argument('--source-branch', type=str, required=True, help='The branch in the source repository from which changes will be merged. Example: master')
+    parser.add_argument('--strategy', choices=['merge', 'cherry-pick'], default='merge', help='Bring the changes in with a merge commit, or cherry-pick the missing source commits one by one. Default: merge')
     return parser.parse_args()
 
+def git_auth_env(github_token):
+    # The token goes in an HTTP header through the environment, never in a URL, config or command line
+    credentials = base64.b64encode(f'x-access-token:{github_token}'.encode()).decode()
+    index = int(os.environ.get('GIT_CONFIG_COUNT', 0))  # Keep any config already passed this way
+    return {
+        'GIT_CONFIG_COUNT': str(index + 2),
+        # An empty value first resets headers set elsewhere, e.g. by actions/checkout
+        f'GIT_CONFIG_KEY_{index}': 'http.https://github.com/.extraheader',
+        f'GIT_CONFIG_VALUE_{index}': '',
+        f'GIT_CONFIG_KEY_{index + 1}': 'http.https://github.com/.extraheader',
+        f'GIT_CONFIG_VALUE_{index + 1}': f'AUTHORIZATION: basic {credentials}',
+    }
+
+def remote_heads(git, remote, branch, *patterns):
+    # One ls-remote for the branch and the branches matching the patterns
+    ls_remote = git.ls_remote(remote, f'refs/heads/{branch}', *(f'refs/heads/{pattern}' for pattern in patterns))
+    heads = {ref.removeprefix('refs/heads/'): sha for sha, ref in (line.split() for line in ls_remote.splitlines())}
+    if branch not in heads:
+        raise ValueError(f"Branch '{branch}' not found in repository '{remote}'.")
+    return heads
+
+def remote_tip(git, remote, branch):
+    return remote_heads(git, remote, branch)[branch]
+
+def local_tips(repo, *refs):
+    # Refs that haven't been fetched yet are left out
+    return dict(line.split() for line in repo.git.for_each_ref('--format=%(refname) %(objectname)', *refs).splitlines())
+
+def commit_list(repo, revision_range, pretty, limit):
+    # Stream the log and stop reading once the list is full
+    lines, size = [], 0
+    log = repo.git.log(revision_range, '--no-merges', f'--pretty=tformat:{pretty}', as_process=True)
+    for line in log.stdout:
+        line = line.decode(errors='replace')
+        if size + len(line) + len(TRUNCATED_NOTE) > limit:
+            log.proc.kill()
+            lines.append(TRUNCATED_NOTE)
+            break
+        lines.append(line)
+        size += len(line)
+    else:
+        log.wait()
+    return ''.join(lines).rstrip('\n')
+
+def scratch_dir():
+    if 'TMPDIR' in os.environ or not os.path.isdir(SCRATCH_DIR):
+        return None  # An explicit TMPDIR wins
+    return SCRATCH_DIR if shutil.disk_usage(SCRATCH_DIR).free >= SCRATCH_MIN_FREE else None
+
+def read_synced_tips(synced_path):
+    return json.loads(synced_path.read_text()) if synced_path.exists() else {}
+
+def record_synced_tip(synced_path, sync_key, source_sha):
+    # Called with the cache lock held, re-read to keep tips other runs recorded
+    synced_tips = read_synced_tips(synced_path)
+    synced_tips[sync_key] = source_sha
+    # Renamed into place so a killed run can't leave a truncated file
+    temp_path = synced_path.with_suffix('.json.tmp')
+    temp_path.write_text(json.dumps(synced_tips, indent=2, sort_keys=True) + '\n')
+    os.replace(temp_path, synced_path)
+
+def lock_cache(cache_path):
+    # Runs sharing a cached clone take turns
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    lock_file = open(cache_path.with_suffix('.lock'), 'w')
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file  # Closing it releases the lock
+
+def open_cached_repo(args, cache_path, target_repo_url, git_env):
+    if cache_path.exists():
+        logging.info(f"Reusing cached clone of target repository '{args.target_repo}'.")
+        repo = Repo(cache_path)
+        repo.git.update_environment(**git_env)
+        repo.git.remote('set-url', 'origin', target_repo_url)
+        repo.git.worktree('prune')  # Forget worktrees of interrupted runs
+        return repo
+
+    # Bare and blob-less, blobs are fetched on demand
+    logging.info(f"Cloning target repository '{args.target_repo}' into cache.")
+    repo = Repo.clone_from(
+        target_repo_url,
+        cache_path,
+        env=git_env,
+        bare=True,
+        multi_options=['--filter=blob:none', '--single-branch', f'--branch={args.target_branch}']
+    )
+    repo.git.update_environment(**git_env)
+    return repo
+
+def pick_range(args, source_ref):
+    # Earlier cherry-picks have new hashes on the target branch, so match them by patch id
+    return '--cherry-pick', '--right-only', f'{args.target_branch}...{source_ref}'
+
+def merge_source(repo, args, source_ref, sync_branch_name):
+    # In-memory merge, on conflicts the tree with conflict markers is committed as is
+    logging.info(f"Merging source branch '{args.source_branch}' into sync branch '{sync_branch_name}'.")
+    status, merge_output, merge_error = repo.git.merge_tree(
+        '--write-tree', args.target_branch, source_ref,
+        with_extended_output=True, with_exceptions=False
+    )
+    if status not in (0, 1) or not merge_output:  # Exit status 1 means conflicts, as long as a tree was written
+        raise GitCommandError(['git', 'merge-tree'], status, merge_error)
+    is_draft = status == 1  # Mark the PR as draft if there's a conflict
+    if is_draft:
+        logging.warning(f"Merge conflict detected. Attempting automatic conflict resolution.")
+    merge_commit = repo.git.commit_tree(
+        merge_output.splitlines()[0], '-p', args.target_branch, '-p', source_ref,
+        '-m', f"Merge branch '{args.source_branch}' of {args.source_repo} into {args.target_branch}"
+    )
+    logging.info(f"Creating new sync branch '{sync_branch_name}' from '{args.target_branch}'.")
+    repo.git.update_ref(f'refs/heads/{sync_branch_name}', merge_commit)
+    return merge_commit, is_draft
+
+def cherry_pick_source(repo, args, source_ref, sync_branch_name, git_env):
+    with tempfile.TemporaryDirectory(dir=scratch_dir()) as temp_dir:
+        worktree_path = Path(temp_dir) / 'worktree'
+        logging.info(f"Creating new sync branch '{sync_branch_name}' from '{args.target_branch}'.")
+        repo.git.worktree('add', '-B', sync_branch_name, str(worktree_path), args.target_branch)
+        try:
+            worktree = Repo(worktree_path)
+            worktree.git.update_environment(**git_env)
+            worktree.git.update_environment(GIT_OPTIONAL_LOCKS='0')  # No opportunistic index refreshes
+
+            is_draft = False
+            try:
+                logging.info(f"Cherry-picking missing commits from source branch '{args.source_branch}'.")
+                worktree.git.cherry_pick('-m1', '-x', '--allow-empty', *pick_range(args, source_ref))
+            except GitCommandError:
+                # git stops on every conflicting commit, resolve it and carry on with the rest of the range
+                cherry_pick_head = Path(worktree.git_dir) / 'CHERRY_PICK_HEAD'
+                while True:
+                    commit = cherry_pick_head.read_text().strip()
+                    worktree.git.add('-u')  # Stage changes to continue
+                    try:
+                        if worktree.git.diff('--cached', '--quiet', with_extended_output=True, with_exceptions=False)[0] == 0:
+                            # Nothing left to apply, the target branch already has this change
+                            logging.info(f"Commit {commit} is already applied on '{args.target_branch}'. Skipping it.")
+                            worktree.git.cherry_pick('--skip')
+                        else:
+                            logging.warning(f"Conflict detected on commit {commit}. Automatically resolving.")
+                            is_draft = True  # Mark PR as draft if there's a conflict
+                            worktree.git.cherry_pick('--continue')
+                        break
+                    except GitCommandError:
+                        if cherry_pick_head.read_text().strip() == commit:
+                            raise  # Still stuck on the same commit
+            commit_count = worktree.git.rev_list('--count', f'{args.target_branch}..HEAD')
+            logging.info(f"Cherry-picked {commit_count} commits into sync branch '{sync_branch_name}'.")
+            return worktree.head.commit.hexsha, is_draft
+        finally:
+            repo.git.worktree('remove', '--force', str(worktree_path))
+
 def sync_repos(args):
     try:
         github_token = os.getenv('GITHUB_TOKEN')
@@ -25,97 +196,154 @@ def sync_repos(args):
             raise ValueError("GitHub token not found. Please set the GITHUB_TOKEN environment variable.")
         
         # Step 1: Initialize GitHub client and get the repository
-        g = Github(github_token)
-        github_repo = g.get_repo(args.target_repo)
+        g = Github(github_token, per_page=100, retry=GithubRetry(status_forcelist=[429, *range(500, 600)]))
+        github_repo = g.get_repo(args.target_repo, lazy=True)
+        target_repo_url = f'https://github.com/{args.target_repo}.git'
+        source_repo_url = f'https://github.com/{args.source_repo}.git'
+        git_env = git_auth_env(github_token)
+        cache_path = CACHE_DIR / hashlib.sha1(args.target_repo.encode()).hexdigest()
+        # Source tips last cherry-picked into each target branch
+        synced_path = cache_path.with_suffix('.json')
+        sync_key = f'{args.source_repo}:{args.source_branch} -> {args.target_branch}'
 
-        with tempfile.TemporaryDirectory() as repo_path:
-            # Step 2: Clone the target repository
-            logging.info(f"Cloning target repository '{args.target_repo}' into temporary directory.")
-            repo = Repo.clone_from(f'https://{github_token}@github.com/{args.target_repo}.git', repo_path)
+        # Step 2: Check if repos are in sync before cloning anything
+        logging.info(f"Resolving latest commit from source branch '{args.source_branch}'.")
+        git = Git()
+        git.update_environment(**git_env)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            target_lookup = executor.submit(remote_heads, git, target_repo_url, args.target_branch, 'sync-branch-*')
+            source_sha = remote_tip(git, source_repo_url, args.source_branch)
+            target_heads = target_lookup.result()
+        target_sha = target_heads[args.target_branch]
+        source_commit = source_sha[:7]
+        logging.info(f"Latest commit from source repo: '{source_commit}'")
 
-            # Step 3: Add the source repository as a remote
-            repo.create_remote('source', f'https://{github_token}@github.com/{args.source_repo}.git')
-            logging.info(f"Added source repository '{args.source_repo}' as a remote.")
+        if args.strategy == 'cherry-pick':
+            # Cherry-picked commits get new hashes, so compare with the recorded tip
+            in_sync = read_synced_tips(synced_path).get(sync_key) == source_sha
+        else:
+            # Check if the commit is already in the target branch
+            try:
+                comparison = github_repo.compare(args.target_branch, source_sha, comparison_commits_per_page=1)
+                in_sync = comparison.status in ('behind', 'identical')
+            except GithubException as e:
+                if e.status != 404:
+                    raise
+                in_sync = False  # The target repository doesn't know the commit at all
+        if in_sync:
+            logging.info("Repositories are in sync. Skipping sync action.")
+            return  # Exit the function early if the commit is already in the target branch
+        logging.info("New commits available. Proceeding with sync.")
 
-            # Step 4: Checkout the target branch and check if repos are in sync
-            logging.info(f"Checking out target branch '{args.target_branch}'.")
-            repo.git.checkout(args.target_branch)
+        # One sync branch per strategy and target branch, slashes flattened to avoid nested refs
+        sync_branch_name = f"sync-branch-{args.strategy}-{args.target_branch.replace('/', '-')}-{source_commit}"
 
-            # Fetch the latest commit from the source branch
-            logging.info(f"Fetching latest commit from source branch '{args.source_branch}'.")
-            repo.git.fetch('source', args.source_branch)
-            source_commit = repo.git.rev_parse(f'source/{args.source_branch}', short=7)
-            logging.info(f"Latest commit from source repo: '{source_commit}'")
+        # Step 3: Check if there's any PR with the latest changes and created new branch for sync if there's none
+        open_prs = github_repo.get_pulls(state='open', head=f"{args.target_repo.split('/')[0]}:{sync_branch_name}", base=args.target_branch)
+        if open_prs.totalCount > 0:
+            logging.info(f"There's already a PR open for the latest changes from {args.source_repo}. Check it here: {open_prs[0].html_url}")
+            if args.strategy == 'cherry-pick':
+                with lock_cache(cache_path):
+                    record_synced_tip(synced_path, sync_key, source_sha)
+            return  # Exit the function early if there's already a PR
 
-            # Check if the commit is already in the target branch
-            try:
-                # If source_commit is an ancestor of the latest commit in target_branch, this will return 0
-                repo.git.merge_base('--is-ancestor', source_commit, args.target_branch)
-                logging.info("Repositories are in sync. Skipping sync action.")
-                return  # Exit the function early if the commit is already in the target branch
-            except GitCommandError:
-                logging.info("New commits available. Proceeding with sync.")
+        with lock_cache(cache_path):
+            # Step 4: Get an up to date clone of the target repository
+            repo = open_cached_repo(args, cache_path, target_repo_url, git_env)
 
-            sync_branch_name = f"sync-branch-{source_commit}"
+            # Step 5: Fetch the target and source branches in parallel, skipping tips the clone already has
+            target_ref, source_ref = f'refs/heads/{args.target_branch}', f'refs/sync/source/{args.source_branch}'
+            tips = local_tips(repo, target_ref, source_ref)
+            fetches = []
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                if tips.get(target_ref) != target_sha:
+                    logging.info(f"Fetching changes from target branch '{args.target_branch}'.")
+                    fetches.append(executor.submit(
+                        repo.git.fetch, 'origin', f'+refs/heads/{args.target_branch}:refs/heads/{args.target_branch}',
+                        '--no-tags', '--no-write-fetch-head', '--no-auto-gc'
+                    ))
+                if tips.get(source_ref) != source_sha:
+                    logging.info(f"Fetching changes from source branch '{args.source_branch}'.")
+                    # No blob filter, lazy fetches only work against the target repository
+                    fetches.append(executor.submit(
+                        repo.git.fetch, source_repo_url, f'+refs/heads/{args.source_branch}:{source_ref}', '--no-tags',
+                        '--no-write-fetch-head', '--no-auto-gc',
+                        f'--negotiation-tip={args.target_branch}', '--negotiation-tip=refs/sync/source/*'
+                    ))
+                for fetch in fetches:
+                    fetch.result()
+            if fetches:
+                repo.git.commit_graph('write', '--reachable')
 
-            # Step 5: Check if there's any PR with the latest changes and created new branch for sync if there's none
-            open_prs = github_repo.get_pulls(state='open', head=f"{args.target_repo.split('/')[0]}:{sync_branch_name}", base=args.target_branch)
-            if open_prs.totalCount > 0:
-                logging.info(f"There's already a PR open for the latest changes from {args.source_repo}. Check it here: {open_prs[0].html_url}")
-                return  # Exit the function early if there's already a PR
+            # Nothing to cherry-pick
+            if args.strategy == 'cherry-pick' and not repo.git.rev_list('--max-count=1', *pick_range(args, source_ref)):
+                logging.info(f"No commits to cherry-pick from source branch '{args.source_branch}'. Skipping sync action.")
+                record_synced_tip(synced_path, sync_key, source_sha)
+                return
 
-            # Create a new branch for the sync
-            logging.info(f"Creating new sync branch '{sync_branch_name}' from '{args.target_branch}'.")
-            repo.git.checkout('-b', sync_branch_name)
+            # Step 6: Bring the source branch into a new sync branch
+            if args.strategy == 'cherry-pick':
+                sync_sha, is_draft = cherry_pick_source(repo, args, source_ref, sync_branch_name, git_env)
+                if sync_sha == target_sha:
+                    # Every commit was skipped
+                    logging.info(f"No commits left to cherry-pick from source branch '{args.source_branch}'. Skipping sync action.")
+                    record_synced_tip(synced_path, sync_key, source_sha)
+                    return
+            else:
+                sync_sha, is_draft = merge_source(repo, args, source_ref, sync_branch_name)
 
-            # Step 6: Merge the source branch into the sync branch
-            is_draft = False
-            try:
-                logging.info(f"Merging source branch '{args.source_branch}' into sync branch '{sync_branch_name}'.")
-                repo.git.merge(f'source/{args.source_branch}')
-            except GitCommandError as e:
-                logging.warning(f"Merge conflict detected. Attempting automatic conflict resolution.")
-                is_draft = True  # Mark the PR as draft if there's a conflict
-                repo.git.add(A=True)  # Stage changes to continue
-                try:
-                    repo.git.commit('--no-edit')  # Commit the resolution
-                except GitCommandError as commit_error:
-                    if 'nothing to commit' in str(commit_error):
-                        logging.info(f"No changes detected after conflict resolution. Proceeding.")
-                    else:
-                        raise commit_error
-
-            # Step 7: Push the new branch to the remote target repository
-            repo.git.remote('set-url', 'origin', f'https://{github_token}@github.com/{args.target_repo}.git')
-            logging.info(f"Pushing new branch '{sync_branch_name}' to the remote target repository.")
-            repo.git.push('origin', sync_branch_name, force=True)
-            
-            # Step 8: Create a pull request with the merge
-            pr_title = f"Sync repositories: from {args.source_repo} into {args.target_repo}"
-            
-            # Gather commits from the sync branch
-            commit_log = repo.git.log(f'{args.target_branch}..{sync_branch_name}', '--no-merges', '--pretty=format:%h %s')
-            # Create links to the commits in the pull request
-            commit_links = []
-            for line in commit_log.splitlines():
-                commit_hash, commit_message = line.split(' ', 1)
-                commit_links.append(f"[{commit_hash}](https://github.com/{args.target_repo}/commit/{commit_hash}) : {commit_message}")
-            
-            # Create a markdown list of commits
-            commit_list = "\n".join(commit_links)
-            pr_body = f"Applying changes from `{args.source_repo}`(branch: `{args.source_branch}`) into `{args.target_repo}`(branch: `{args.target_branch}`).\n\n### List of commits:\n{commit_list}"
+            # Step 7: Push the new branch to the remote target repository, while the PR body is built
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                push = None
+                remote_sync_sha = target_heads.get(sync_branch_name)
+                if remote_sync_sha == sync_sha:
+                    logging.info(f"Branch '{sync_branch_name}' is already up to date in the remote target repository.")
+                else:
+                    logging.info(f"Pushing new branch '{sync_branch_name}' to the remote target repository.")
+                    push = executor.submit(
+                        repo.git.push,
+                        'origin', f'--force-with-lease=refs/heads/{sync_branch_name}:{remote_sync_sha or ""}',
+                        f'refs/heads/{sync_branch_name}:refs/heads/{sync_branch_name}'
+                    )
 
-            try:
-                pull_request = github_repo.create_pull(
-                    title=pr_title,
-                    body=pr_body,
-                    head=sync_branch_name,
-                    base=args.target_branch,
-                    draft=is_draft
+                # Gather commits from the sync branch as a markdown list
+                action = 'Cherry-picking' if args.strategy == 'cherry-pick' else 'Applying'
+                pr_intro = f"{action} changes from `{args.source_repo}`(branch: `{args.source_branch}`) into `{args.target_repo}`(branch: `{args.target_branch}`).\n\n### List of commits:\n"
+                pr_body = pr_intro + commit_list(
+                    repo,
+                    f'{args.target_branch}..{sync_branch_name}',
+                    f'[%h](https://github.com/{args.target_repo}/commit/%H) : %s',
+                    PR_BODY_LIMIT - len(pr_intro)
                 )
-                logging.info(f"Pull request created: {pull_request.html_url}")
-            except GithubException as e:
+                if push:
+                    push.result()
+
+        # Step 8: Create a pull request with the merge or the cherry-picked commits
+        if args.strategy == 'cherry-pick':
+            pr_title = f"Sync changes from {args.source_branch} to {args.target_branch}"
+        else:
+            pr_title = f"Sync repositories: from {args.source_repo} into {args.target_repo}"
+
+        try:
+            pull_request = github_repo.create_pull(
+                title=pr_title,
+                body=pr_body,
+                head=sync_branch_name,
+                base=args.target_branch,
+                draft=is_draft
+            )
+            logging.info(f"Pull request created: {pull_request.html_url}")
+        except GithubException as e:
+            if e.status == 422 and 'already exists' in str(e.data):
+                # Another run opened it after our check
+                logging.info(f"There's already a PR open for '{sync_branch_name}'. Skipping creation.")
+            else:
                 logging.error(f"Failed to create pull request: {e}")
+                return  # Not recorded as synced, the next run tries again
+
+        if args.strategy == 'cherry-pick':
+            with lock_cache(cache_path):
+                record_synced_tip(synced_path, sync_key, source_sha)
 
     except Exception as e:
         logging.error(f"An error occurred: {e}")
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import os
+import subprocess
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+from git import Repo
+from github import GithubException
+
+import sync_repositories as sync
+
+SOURCE_REF = 'refs/sync/source/main'
+
+class SyncTestCase(unittest.TestCase):
+    # A source and a target working repository sharing one base commit, and a bare clone of the target branch
+    # standing in for the cached clone, with the source branch fetched into it the way sync_repos does
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.root = root = Path(temp_dir.name)
+        env = mock.patch.dict(os.environ, {
+            'GIT_CONFIG_GLOBAL': os.devnull,
+            'GIT_CONFIG_NOSYSTEM': '1',
+            'GIT_AUTHOR_NAME': 'Test', 'GIT_AUTHOR_EMAIL': 'test@example.com',
+            'GIT_COMMITTER_NAME': 'Test', 'GIT_COMMITTER_EMAIL': 'test@example.com',
+        })
+        env.start()
+        self.addCleanup(env.stop)
+
+        # Laid out like GitHub URLs, so that sync_repos can reach them too
+        self.source = Repo.init(root / 'o' / 'source.git', initial_branch='main')
+        self.commit(self.source, 'f1', 'base\n', 'base')
+        self.target = Repo.clone_from(self.source.working_dir, root / 'o' / 'target.git')
+        self.repo = Repo.init(root / 'cache.git', bare=True)
+        self.args = argparse.Namespace(
+            target_repo='o/target', source_repo='o/source', target_branch='main', source_branch='main',
+            strategy=self.strategy
+        )
+
+    def commit(self, repo, name, content, message):
+        Path(repo.working_dir, name).write_text(content)
+        repo.git.add(name)
+        repo.git.commit('-m', message)
+
+    def fetch(self):
+        self.repo.git.fetch(self.target.working_dir, '+main:main')
+        self.repo.git.fetch(self.source.working_dir, f'+main:{SOURCE_REF}')
+
+    def merge_pull_request(self, sync_branch_name):
+        # What merging the sync PR on GitHub does to the target branch
+        self.target.git.fetch(self.repo.git_dir, sync_branch_name)
+        self.target.git.merge('--ff-only', 'FETCH_HEAD')
+
+    def synced_subjects(self, sync_branch_name):
+        return self.repo.git.log('--format=%s', f'main..{sync_branch_name}').splitlines()
+
+class CherryPickSourceTest(SyncTestCase):
+    strategy = 'cherry-pick'
+
+    def cherry_pick(self):
+        self.fetch()
+        return sync.cherry_pick_source(self.repo, self.args, SOURCE_REF, 'sync-branch', {})
+
+    def test_second_sync_picks_only_new_commits(self):
+        self.commit(self.source, 'f2', 'first\n', 'src first')
+        _, is_draft = self.cherry_pick()
+        self.assertFalse(is_draft)
+        self.assertEqual(self.synced_subjects('sync-branch'), ['src first'])
+        self.merge_pull_request('sync-branch')
+
+        self.fetch()
+        self.assertEqual(self.repo.git.rev_list('--max-count=1', *sync.pick_range(self.args, SOURCE_REF)), '')
+
+        self.commit(self.source, 'f2', 'second\n', 'src second')
+        _, is_draft = self.cherry_pick()
+        self.assertFalse(is_draft)
+        self.assertEqual(self.synced_subjects('sync-branch'), ['src second'])
+
+    def test_conflict_resolved_on_target_is_skipped(self):
+        self.commit(self.source, 'f1', 'src\n', 'src change')
+        self.commit(self.target, 'f1', 'tgt\n', 'tgt change')
+        _, is_draft = self.cherry_pick()
+        self.assertTrue(is_draft)
+        self.assertIn('<<<<<<<', self.repo.git.show('sync-branch:f1'))
+
+        # The conflict is resolved by hand before the PR is merged, so the commit on the target branch has another
+        # patch id and is picked again by the next sync, where it changes nothing
+        self.merge_pull_request('sync-branch')
+        self.commit(self.target, 'f1', 'src\n', 'resolve conflict')
+        self.commit(self.source, 'f2', 'new\n', 'src new')
+        sync_sha, is_draft = self.cherry_pick()
+        self.assertFalse(is_draft)
+        self.assertEqual(self.synced_subjects('sync-branch'), ['src new'])
+        self.assertEqual(self.repo.git.show(f'{sync_sha}:f1'), 'src')
+
+class MergeSourceTest(SyncTestCase):
+    strategy = 'merge'
+
+    def merge(self):
+        self.fetch()
+        return sync.merge_source(self.repo, self.args, SOURCE_REF, 'sync-branch')
+
+    def test_merge(self):
+        self.commit(self.source, 'f2', 'src\n', 'src add f2')
+        self.commit(self.target, 'f3', 'tgt\n', 'tgt add f3')
+        merge_commit, is_draft = self.merge()
+        self.assertFalse(is_draft)
+        self.assertEqual(self.repo.git.rev_parse('sync-branch'), merge_commit)
+        self.assertEqual(self.repo.git.rev_parse(f'{merge_commit}^1'), self.target.head.commit.hexsha)
+        self.assertEqual(self.repo.git.rev_parse(f'{merge_commit}^2'), self.source.head.commit.hexsha)
+        self.assertEqual(self.repo.git.show(f'{merge_commit}:f2'), 'src')
+        self.assertEqual(self.repo.git.show(f'{merge_commit}:f3'), 'tgt')
+        self.assertEqual(self.synced_subjects('sync-branch'), ["Merge branch 'main' of o/source into main", 'src add f2'])
+
+    def test_conflict_is_committed_with_markers(self):
+        self.commit(self.source, 'f1', 'src\n', 'src change')
+        self.commit(self.source, 'f2', 'src\n', 'src add f2')
+        self.commit(self.target, 'f1', 'tgt\n', 'tgt change')
+        merge_commit, is_draft = self.merge()
+        self.assertTrue(is_draft)
+        conflicted = self.repo.git.show(f'{merge_commit}:f1')
+        self.assertIn('<<<<<<<', conflicted)
+        self.assertIn('tgt', conflicted)
+        self.assertIn('src', conflicted)
+        self.assertEqual(self.repo.git.show(f'{merge_commit}:f2'), 'src')
+
+    def test_merge_tree_failure_raises(self):
+        self.fetch()
+        with self.assertRaises(sync.GitCommandError):
+            sync.merge_source(self.repo, self.args, 'refs/sync/source/missing', 'sync-branch')
+        self.assertEqual(self.repo.git.for_each_ref('refs/heads/sync-branch'), '')
+
+class SyncReposTest(SyncTestCase):
+    # Runs the whole sync against the local repositories, with GitHub URLs rewritten to them and the API mocked
+    strategy = 'merge'
+
+    def setUp(self):
+        super().setUp()
+        env = mock.patch.dict(os.environ, {
+            'GITHUB_TOKEN': 'token',
+            'GIT_CONFIG_COUNT': '1',
+            'GIT_CONFIG_KEY_0': f'url.{self.root}/.insteadOf',
+            'GIT_CONFIG_VALUE_0': 'https://github.com/',
+        })
+        env.start()
+        self.addCleanup(env.stop)
+        cache_dir = mock.patch.object(sync, 'CACHE_DIR', self.root / 'cache')
+        cache_dir.start()
+        self.addCleanup(cache_dir.stop)
+        github = mock.patch.object(sync, 'Github')
+        self.github_repo = github.start().return_value.get_repo.return_value
+        self.addCleanup(github.stop)
+        self.github_repo.get_pulls.return_value.totalCount = 0
+        self.github_repo.compare.return_value.status = 'diverged'
+        self.github_repo.create_pull.return_value.html_url = 'https://github.com/o/target/pull/1'
+
+    def sync_repos(self, strategy):
+        with self.assertNoLogs(level='ERROR'):
+            sync.sync_repos(argparse.Namespace(**{**vars(self.args), 'strategy': strategy}))
+
+    def sync_branch(self, strategy):
+        return f'sync-branch-{strategy}-main-{self.source.head.commit.hexsha[:7]}'
+
+    def synced_tips(self):
+        return sync.read_synced_tips((sync.CACHE_DIR / hashlib.sha1(b'o/target').hexdigest()).with_suffix('.json'))
+
+    def test_merge_strategy(self):
+        self.commit(self.source, 'f2', 'src\n', 'src add f2')
+        self.commit(self.target, 'f3', 'tgt\n', 'tgt add f3')
+        self.sync_repos('merge')
+        sync_commit = self.target.commit(self.sync_branch('merge'))
+        self.assertEqual([parent.hexsha for parent in sync_commit.parents], [self.target.head.commit.hexsha, self.source.head.commit.hexsha])
+        pull = self.github_repo.create_pull.call_args.kwargs
+        self.assertEqual(pull['head'], self.sync_branch('merge'))
+        self.assertEqual(pull['title'], 'Sync repositories: from o/source into o/target')
+        self.assertFalse(pull['draft'])
+        self.assertEqual(self.synced_tips(), {})
+
+    def test_cherry_pick_strategy(self):
+        self.commit(self.source, 'f2', 'src\n', 'src add f2')
+        self.commit(self.target, 'f3', 'tgt\n', 'tgt add f3')
+        self.sync_repos('cherry-pick')
+        sync_branch = self.sync_branch('cherry-pick')
+        self.assertEqual(self.target.git.log('--format=%s', f'main..{sync_branch}').splitlines(), ['src add f2'])
+        self.assertEqual([parent.hexsha for parent in self.target.commit(sync_branch).parents], [self.target.head.commit.hexsha])
+        pull = self.github_repo.create_pull.call_args.kwargs
+        self.assertEqual(pull['head'], sync_branch)
+        self.assertEqual(pull['title'], 'Sync changes from main to main')
+        self.assertEqual(self.synced_tips(), {'o/source:main -> main': self.source.head.commit.hexsha})
+
+    def test_merged_source_tip_skips_before_cloning(self):
+        self.github_repo.compare.return_value.status = 'behind'
+        self.sync_repos('merge')
+        self.assertFalse(sync.CACHE_DIR.exists())
+        self.github_repo.get_pulls.assert_not_called()
+        self.github_repo.create_pull.assert_not_called()
+
+    def test_recorded_source_tip_skips_before_cloning(self):
+        self.commit(self.source, 'f2', 'src\n', 'src add f2')
+        sync.CACHE_DIR.mkdir()
+        synced_path = (sync.CACHE_DIR / hashlib.sha1(b'o/target').hexdigest()).with_suffix('.json')
+        sync.record_synced_tip(synced_path, 'o/source:main -> main', self.source.head.commit.hexsha)
+        self.sync_repos('cherry-pick')
+        self.assertEqual([path.suffix for path in sync.CACHE_DIR.iterdir()], ['.json'])
+        self.github_repo.get_pulls.assert_not_called()
+        self.github_repo.create_pull.assert_not_called()
+
+    def test_existing_pull_request_records_tip(self):
+        # Another run opened the PR between the lookup and create_pull
+        self.commit(self.source, 'f2', 'src\n', 'src add f2')
+        self.github_repo.create_pull.side_effect = GithubException(
+            422, {'message': 'Validation Failed', 'errors': [{'message': 'A pull request already exists for o:sync-branch.'}]}
+        )
+        self.sync_repos('cherry-pick')
+        self.assertEqual(self.synced_tips(), {'o/source:main -> main': self.source.head.commit.hexsha})
+        self.assertIn(self.sync_branch('cherry-pick'), self.target.git.branch('--format=%(refname:short)').splitlines())
+
+        self.github_repo.create_pull.reset_mock()
+        self.sync_repos('cherry-pick')
+        self.github_repo.create_pull.assert_not_called()
+
+    def test_open_pull_request_records_tip(self):
+        self.commit(self.source, 'f2', 'src\n', 'src add f2')
+        self.github_repo.get_pulls.return_value.totalCount = 1
+        self.sync_repos('cherry-pick')
+        self.assertEqual(self.github_repo.get_pulls.call_args.kwargs['head'], f"o:{self.sync_branch('cherry-pick')}")
+        self.github_repo.create_pull.assert_not_called()
+        self.assertEqual(self.synced_tips(), {'o/source:main -> main': self.source.head.commit.hexsha})
+
+class CommitListTest(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.repo = Repo.init(temp_dir.name, bare=True)
+        # Far more commits than fit in a PR body, written by a single fast-import
+        stream = ''.join(
+            f'commit refs/heads/main\ncommitter Test <test@example.com> {i} +0000\ndata {len(f"commit {i:04}")}\ncommit {i:04}\n'
+            for i in range(2000)
+        )
+        subprocess.run(['git', 'fast-import', '--quiet'], cwd=self.repo.git_dir, input=stream.encode(), check=True)
+
+    def test_truncated_at_body_limit(self):
+        body = sync.commit_list(self.repo, 'main', '%H : %s', sync.PR_BODY_LIMIT)
+        self.assertLessEqual(len(body), sync.PR_BODY_LIMIT)
+        self.assertTrue(body.endswith(sync.TRUNCATED_NOTE))
+        lines = body[:-len(sync.TRUNCATED_NOTE)].splitlines()
+        self.assertEqual(lines[0], f"{self.repo.commit('main').hexsha} : commit 1999")
+        self.assertEqual(lines[-1], f"{self.repo.commit(f'main~{len(lines) - 1}').hexsha} : commit {2000 - len(lines):04}")
+
+    def test_short_list_is_complete(self):
+        body = sync.commit_list(self.repo, 'main~2..main', '%s', sync.PR_BODY_LIMIT)
+        self.assertEqual(body, 'commit 1999\ncommit 1998')
+
+class SyncedTipsTest(unittest.TestCase):
+    def test_record_keeps_other_entries(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            synced_path = Path(temp_dir) / 'cache.json'
+            self.assertEqual(sync.read_synced_tips(synced_path), {})
+            sync.record_synced_tip(synced_path, 'a', '1')
+            sync.record_synced_tip(synced_path, 'b', '2')
+            sync.record_synced_tip(synced_path, 'a', '3')
+            self.assertEqual(sync.read_synced_tips(synced_path), {'a': '3', 'b': '2'})
+            self.assertEqual(sorted(path.name for path in Path(temp_dir).iterdir()), ['cache.json'])
+
+if __name__ == '__main__':
+    unittest.main()